@@ -3,7 +3,7 @@
 Main entry point for Visual MCP Server
 """
 
-from visual_mcp.server import mcp
+from visual_mcp.server import main
 
 if __name__ == "__main__":
-    mcp.run()
+    main()
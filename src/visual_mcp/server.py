@@ -7,16 +7,207 @@ One tool for all your visual analysis needs.
 """
 
 import asyncio
-import base64
+import hashlib
+import io
+import logging
 import mimetypes
+import mmap
 import os
-import traceback
+import random
+import re
+import time
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import UTC, datetime
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING, BinaryIO, cast
 
 import httpx
+import orjson
 from mcp.server.fastmcp import Context, FastMCP
+from mcp.shared.exceptions import McpError
+from mcp.types import INTERNAL_ERROR, INVALID_PARAMS, ErrorData
 from pydantic import BaseModel, Field
 
+if TYPE_CHECKING:
+    from typing_extensions import Buffer
+
+# The subset of the codec used here, common to pybase64 and the stdlib
+b64decode: "Callable[[str | Buffer], bytes]"
+b64encode_as_string: "Callable[[Buffer], str]"
+
+try:
+    from pybase64 import b64decode, b64encode_as_string
+except ImportError:  # pybase64 is optional; the stdlib codec is just slower
+    import base64
+
+    b64decode = base64.b64decode
+
+    def _b64encode_as_string(s: "Buffer") -> str:
+        """Base64 encode a buffer straight to a str"""
+        return base64.b64encode(s).decode("ascii")
+
+    b64encode_as_string = _b64encode_as_string
+
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are sent as-is
+    Image = None  # type: ignore[assignment]
+    ImageOps = None  # type: ignore[assignment]
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True, slots=True)
+class GlmConfig:
+    """Connection settings for the GLM vision API, read once at import"""
+
+    api_key: str = field(repr=False)
+    api_base: str
+    model: str
+    headers: dict[str, str] = field(init=False, repr=False, compare=False)
+    completions_url: str = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self) -> None:
+        # The request URL and headers never change, so build them once
+        object.__setattr__(
+            self, "completions_url", f"{self.api_base.rstrip('/')}/chat/completions"
+        )
+        object.__setattr__(
+            self,
+            "headers",
+            {
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+            },
+        )
+
+    @classmethod
+    def from_env(cls) -> "GlmConfig":
+        """Build the configuration from environment variables"""
+        return cls(
+            api_key=os.getenv("GLM_API_KEY", ""),
+            api_base=os.getenv("GLM_API_BASE", "https://nano-gpt.com/api/v1"),
+            model=os.getenv("GLM_MODEL_NAME", "zai-org/GLM-4.5V-FP8"),
+        )
+
+    def validate(self) -> None:
+        """Raise a clear error if required settings are missing"""
+        if not self.api_key:
+            raise ValueError("GLM_API_KEY environment variable not set")
+
+        if not self.api_base:
+            raise ValueError("GLM_API_BASE environment variable not set")
+
+
+# Configuration
+_CFG = GlmConfig.from_env()
+GLM_MAX_CONCURRENCY = int(os.getenv("GLM_MAX_CONCURRENCY", "8"))
+GLM_MAX_PER_SECOND = float(os.getenv("GLM_MAX_PER_SECOND", "0"))
+VISUAL_MCP_CACHE_SIZE = int(os.getenv("VISUAL_MCP_CACHE_SIZE", "512"))
+VISUAL_MCP_MAX_EDGE = int(os.getenv("VISUAL_MCP_MAX_EDGE", "1568"))
+
+# Images smaller than this are uploaded untouched; re-encoding them would cost
+# more CPU than the bandwidth and vision tokens it saves
+DOWNSCALE_MIN_BYTES = 512 * 1024
+
+# Inputs at least this long are never treated as file paths (Linux PATH_MAX)
+MAX_PATH_LENGTH = 4096
+
+# Prompt sent with every image, followed directly by the user's context. All
+# fixed guidance comes first so that requests share an identical prefix, which
+# providers with automatic prompt caching can reuse instead of re-processing.
+PROMPT_PREFIX = """
+You are a comprehensive visual analysis assistant. The user has provided
+an image and specific context about what they need.
+
+Based on their context, provide the most appropriate analysis which may include:
+- Detailed description of visual elements
+- Text extraction and transcription (if text is present)
+- Diagram/technical analysis (if it's a diagram, chart, or technical drawing)
+- Summary of key information
+- Identification of issues, patterns, or insights
+- Step-by-step explanations when appropriate
+
+Adapt your response style and focus based on what the user is asking for.
+Be thorough but concise.
+
+USER CONTEXT: """
+
+# Explicitly supported image formats based on official GLM-4.5V documentation.
+# PNG is shown in the official example, JPEG/JPG mentioned in video API
+SUPPORTED_IMAGE_FORMATS = frozenset({"image/jpeg", "image/jpg", "image/png"})
+
+# Header of a base64 image data URL, capturing the declared mime type
+_DATA_URL_RE = re.compile(
+    r"data:(image/[a-z0-9.+-]+)(?:;[^;,]*)*?;base64,", re.IGNORECASE
+)
+
+# Base64 alphabet followed by at most two padding characters
+_BASE64_RE = re.compile(r"([A-Za-z0-9+/]*)={0,2}")
+
+# Shared HTTP client so consecutive calls reuse pooled keep-alive connections
+# instead of paying a fresh TCP + TLS handshake per request
+_client: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared GLM HTTP client, creating it on first use
+
+    A client closed by the server shutting down is replaced, so the module
+    keeps working if the server is started again in the same process. The
+    transport retries failed connection attempts itself; call_glm_vision_api
+    retries other transient failures on top of that.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        # No base URL: each call targets its own config's completions_url, so
+        # one pool serves any config without sending a key to the wrong host
+        _client = httpx.AsyncClient(
+            timeout=httpx.Timeout(120.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(
+                    max_keepalive_connections=20,
+                    max_connections=100,
+                    keepalive_expiry=30,
+                ),
+                retries=2,
+            ),
+        )
+    return _client
+
+
+# Number of MCP sessions currently running; the lifespan is entered once per
+# session (e.g. per SSE or streamable-HTTP connection)
+_active_sessions = 0
+
+
+@asynccontextmanager
+async def _lifespan(server: FastMCP) -> AsyncIterator[None]:
+    """Validate the configuration on startup and release resources on shutdown"""
+    global _active_sessions
+    # Fail once at startup rather than on every tool call
+    _CFG.validate()
+    _get_semaphore()
+    _active_sessions += 1
+    try:
+        yield
+    finally:
+        _active_sessions -= 1
+        # The client and in-flight calls are shared by every session, so only
+        # the last session to end may release them
+        if _active_sessions == 0:
+            await _single_flight.aclose()
+            if _client is not None:
+                await _client.aclose()
+
+
 # Initialize FastMCP server
 mcp = FastMCP(
     "Visual MCP",
@@ -26,13 +217,9 @@ I am a visual analysis assistant powered by GLM vision models.
 you want to know, and I'll provide comprehensive analysis including descriptions,
 text extraction, diagram analysis, or summaries as needed.
 """,
+    lifespan=_lifespan,
 )
 
-# Configuration
-GLM_API_BASE = os.getenv("GLM_API_BASE", "https://nano-gpt.com/api/v1")
-GLM_API_KEY = os.getenv("GLM_API_KEY")
-GLM_MODEL_NAME = os.getenv("GLM_MODEL_NAME", "zai-org/GLM-4.5V-FP8")
-
 
 class ImageAnalysisRequest(BaseModel):
     """Unified request model for image analysis"""
@@ -50,42 +237,131 @@ class ImageAnalysisRequest(BaseModel):
     )
 
 
-def prepare_image_for_api(image_input: str) -> tuple[str, str]:
-    """Prepare image data for API call and return (base64_data, mime_type)"""
-    # Check if it's a file path
-    if os.path.exists(image_input):
-        return encode_file_to_base64(image_input)
+async def prepare_image_for_api(image_input: str) -> tuple[str, bool]:
+    """Prepare image data for API call and return (data_url, already_validated)
 
-    # Check if it's a base64 string with data URL prefix
-    if image_input.startswith("data:image"):
-        # Extract mime type and base64 part from data URL
-        try:
-            header, data = image_input.split(",", 1)
-            mime_type = header.split(";", 1)[0].split(":", 1)[
-                1
-            ]  # Extract "image/xxx" from "data:image/xxx;base64"
-            return data, mime_type
-        except (IndexError, ValueError):
-            # Fallback to default if parsing fails
-            return image_input.split(",", 1)[1], "image/jpeg"
+    ``already_validated`` is True when the base64 payload is known to be valid,
+    because this function produced it (files and downscaled images) or has
+    already checked it (raw base64), so the API call can skip checking it
+    again.
+    """
+    # Classify the input by the anchored header match and a length check
+    # first, so large base64 payloads never reach a stat() call as a
+    # pathological "path". Only the header is matched; the payload is never
+    # scanned or copied
+    match = _DATA_URL_RE.match(image_input)
+    if match is not None:
+        declared_mime_type = match.group(1)
+        payload_start = match.end()
+        # Trust the image's magic bytes over a mislabelled declared type
+        mime_type = (
+            sniff_image_mime_type(image_input, payload_start) or declared_mime_type
+        )
+    elif image_input[:5].lower() == "data:":
+        raise ValueError("Invalid data URL: expected 'data:image/<type>;base64,<data>'")
+    elif len(image_input) < MAX_PATH_LENGTH and os.path.exists(image_input):
+        # Read and encode the file off the event loop
+        base64_data, mime_type = await asyncio.to_thread(
+            encode_file_to_base64, image_input
+        )
+        return build_data_url(base64_data, mime_type), True
     else:
-        # Assume it's already base64 encoded, but we need to detect format
-        # For now, default to JPEG, but could implement format detection
-        return image_input, "image/jpeg"
+        # Otherwise it must be raw base64. Check it now, with the compiled
+        # charset regex, so a mistyped file path fails before the payload is
+        # hashed, queued for the API or decoded for downscaling
+        if not is_valid_base64(image_input):
+            raise ValueError(
+                "Image data is not an existing file, a data URL or valid base64"
+            )
+        # Detect the format from the image's magic bytes
+        mime_type = sniff_image_mime_type(image_input) or "image/jpeg"
+        payload_start = 0
+
+    # Shrink oversized images before upload
+    if can_downscale() and (len(image_input) - payload_start) * 3 // 4 > (
+        DOWNSCALE_MIN_BYTES
+    ):
+        downscaled = await asyncio.to_thread(
+            downscale_base64_image, image_input, payload_start
+        )
+        if downscaled is not None:
+            return downscaled, True
+
+    if payload_start == 0:
+        return build_data_url(image_input, mime_type), True
+
+    # Forward the data URL unchanged when its mime type is already
+    # acceptable, so a multi-megabyte payload is never split and rejoined
+    normalized_mime_type = validate_image_format(mime_type)
+    if normalized_mime_type == declared_mime_type:
+        return image_input, False
+    return build_data_url(image_input[payload_start:], normalized_mime_type), False
+
+
+def sniff_image_mime_type(base64_data: str, start: int = 0) -> str | None:
+    """Detect the image format from the magic bytes of base64 image data
+
+    Only the first few bytes (from index ``start``) are decoded. Returns None
+    when the format is not recognized.
+    """
+    try:
+        header = b64decode(base64_data[start : start + 16])
+    except ValueError:
+        return None
+
+    if header.startswith(b"\x89PNG"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    return None
+
+
+def build_data_url(base64_data: str, mime_type: str) -> str:
+    """Build the data URL sent to the vision API"""
+    return f"data:{validate_image_format(mime_type)};base64,{base64_data}"
+
+
+@lru_cache(maxsize=64)
+def _mime_for_ext(ext: str) -> str:
+    """Map a lowercased file extension to an image mime type"""
+    mime_type, _ = mimetypes.guess_type(f"x{ext}")
+    if not mime_type or not mime_type.startswith("image/"):
+        # Default to JPEG if we can't determine the type
+        return "image/jpeg"
+    return mime_type
 
 
-def encode_file_to_base64(file_path: str | Path) -> tuple[str, str]:
-    """Encode file to base64 string and detect mime type"""
+def encode_file_to_base64(file_path: str | Path | BinaryIO) -> tuple[str, str]:
+    """Encode file to base64 string and detect mime type
+
+    ``file_path`` may also be an open binary file such as ``io.BytesIO``; it
+    is read from its current position and typed by its ``name``, if any.
+    """
     try:
-        # Detect mime type from file extension
-        mime_type, _ = mimetypes.guess_type(str(file_path))
-        if not mime_type or not mime_type.startswith("image/"):
-            # Default to JPEG if we can't determine the type
-            mime_type = "image/jpeg"
+        if not isinstance(file_path, str | os.PathLike):
+            name = getattr(file_path, "name", "")
+            ext = os.path.splitext(name)[1] if isinstance(name, str) else ""
+            return encode_image_bytes(file_path.read(), _mime_for_ext(ext.lower()))
+
+        # Detect mime type from file extension; the handful of extensions
+        # seen in practice are served from the cache
+        mime_type = _mime_for_ext(os.path.splitext(file_path)[1].lower())
 
         with open(file_path, "rb") as file:
-            base64_data = base64.b64encode(file.read()).decode("utf-8")
-            return base64_data, mime_type
+            if os.fstat(file.fileno()).st_size == 0:
+                # mmap can't map an empty file
+                return "", mime_type
+
+            # Map the file instead of reading it into a bytes copy; the page
+            # cache backs the data and repeated reads of a file stay cheap.
+            # Encoding straight to a str also skips an intermediate bytes
+            # result, so only the raw mapping and the base64 text are resident
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return encode_image_bytes(mapped, mime_type)
     except FileNotFoundError:
         raise ValueError(f"File not found: {file_path}") from None
     except PermissionError:
@@ -94,67 +370,233 @@ def encode_file_to_base64(file_path: str | Path) -> tuple[str, str]:
         raise ValueError(f"Failed to encode file {file_path}: {e}") from None
 
 
-def is_valid_base64(base64_string: str) -> bool:
-    """Check if a string is valid base64"""
+def encode_image_bytes(raw: bytes | mmap.mmap, mime_type: str) -> tuple[str, str]:
+    """Base64 encode image bytes, downscaling them first when oversized"""
+    downscaled = downscale_image(raw)
+    if downscaled is not None:
+        raw, mime_type = downscaled
+    return b64encode_as_string(raw), mime_type
+
+
+def can_downscale() -> bool:
+    """Check whether oversized images can be downscaled before upload"""
+    return Image is not None and VISUAL_MCP_MAX_EDGE > 0
+
+
+def downscale_image(raw: bytes | mmap.mmap) -> tuple[bytes, str] | None:
+    """Shrink an oversized image and return (image_bytes, mime_type)
+
+    The long edge is capped at VISUAL_MCP_MAX_EDGE and the image re-encoded as
+    JPEG (or PNG when it has transparency). Returns None when Pillow is not
+    installed, the image is already small, it cannot be decoded, or the result
+    would not be smaller than the original.
+    """
+    if not can_downscale() or len(raw) <= DOWNSCALE_MIN_BYTES:
+        return None
+
     try:
-        # Add padding if needed
-        padding_needed = len(base64_string) % 4
-        if padding_needed:
-            base64_string += "=" * (4 - padding_needed)
-
-        # Try to decode
-        base64.b64decode(base64_string, validate=True)
-        return True
-    except Exception:
+        # A memory-mapped file is already a seekable binary file (read, seek,
+        # tell are all Pillow needs), so avoid copying it
+        source = cast(BinaryIO, raw) if isinstance(raw, mmap.mmap) else io.BytesIO(raw)
+        with Image.open(source) as original:
+            # Re-encoding drops EXIF, including the Orientation tag phone
+            # cameras rely on, so rotate the pixels upright first
+            image = ImageOps.exif_transpose(original)
+            image.thumbnail(
+                (VISUAL_MCP_MAX_EDGE, VISUAL_MCP_MAX_EDGE), Image.Resampling.LANCZOS
+            )
+            output = io.BytesIO()
+            if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+                image.save(output, format="PNG", optimize=True)
+                mime_type = "image/png"
+            else:
+                image.convert("RGB").save(output, format="JPEG", quality=85)
+                mime_type = "image/jpeg"
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+    resized = output.getvalue()
+    if len(resized) >= len(raw):
+        return None
+    return resized, mime_type
+
+
+def downscale_base64_image(image_input: str, payload_start: int) -> str | None:
+    """Downscale base64 image data and return it as a data URL, if it shrinks"""
+    try:
+        raw = b64decode(image_input[payload_start:])
+    except ValueError:
+        return None
+
+    downscaled = downscale_image(raw)
+    if downscaled is None:
+        return None
+
+    resized, mime_type = downscaled
+    return build_data_url(b64encode_as_string(resized), mime_type)
+
+
+def is_valid_base64(base64_string: str, start: int = 0) -> bool:
+    """Check if a string (from index ``start``) is valid base64 without decoding"""
+    # A charset scan is enough here; the payload is forwarded as-is, so fully
+    # decoding multi-megabyte images just to discard the bytes is wasted work
+    match = _BASE64_RE.fullmatch(base64_string, start)
+    if match is None:
+        return False
+
+    # Padding may be omitted, but a single dangling character can never decode
+    data_length = match.end(1) - start
+    if data_length % 4 == 1:
         return False
 
+    # When padding is present it must complete the final 4-character block
+    total_length = len(base64_string) - start
+    return data_length == total_length or total_length % 4 == 0
+
 
 def validate_image_format(mime_type: str) -> str:
     """Validate and normalize image format"""
-    # List of explicitly supported image formats based on official
-    # GLM-4.5V documentation
-    # PNG is shown in the official example, JPEG/JPG mentioned in video API
-    supported_formats = {"image/jpeg", "image/jpg", "image/png"}
+    # Fast path: already a lowercase supported type, nothing to allocate
+    if mime_type in SUPPORTED_IMAGE_FORMATS:
+        return mime_type
 
     # Normalize to lowercase
     mime_type = mime_type.lower()
 
-    if mime_type not in supported_formats:
+    if mime_type not in SUPPORTED_IMAGE_FORMATS:
         # Default to JPEG for unsupported formats (most universally supported)
         return "image/jpeg"
 
     return mime_type
 
 
+class RateLimiter:
+    """Async token bucket limiting how many requests may start per second
+
+    A ``rate`` of 0 or less disables limiting. Tokens are checked and taken
+    without awaiting in between, so no lock is needed on a single event loop.
+    """
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.capacity = max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        """Wait until a request may be started"""
+        if self.rate <= 0:
+            return
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+# Bound the number of in-flight GLM requests and how fast new ones start, so
+# a burst of tool invocations can't exhaust sockets or trip provider limits
+_glm_semaphore: asyncio.Semaphore | None = None
+_glm_semaphore_loop: asyncio.AbstractEventLoop | None = None
+_rate_limiter = RateLimiter(GLM_MAX_PER_SECOND)
+
+
+def _get_semaphore() -> asyncio.Semaphore:
+    """Return the semaphore bounding concurrent GLM requests, creating it on use
+
+    A semaphore binds to the event loop it is first contended on, so a new one
+    is made for each loop, letting the server start again in the same process.
+    """
+    global _glm_semaphore, _glm_semaphore_loop
+    if GLM_MAX_CONCURRENCY < 1:
+        raise ValueError(
+            f"GLM_MAX_CONCURRENCY must be at least 1, got {GLM_MAX_CONCURRENCY}"
+        )
+    loop = asyncio.get_running_loop()
+    if _glm_semaphore is None or _glm_semaphore_loop is not loop:
+        _glm_semaphore = asyncio.Semaphore(GLM_MAX_CONCURRENCY)
+        _glm_semaphore_loop = loop
+    return _glm_semaphore
+
+
+# Client errors that may succeed when the same request is sent again
+RETRYABLE_CLIENT_ERRORS = frozenset({408, 425, 429})
+
+
+def is_retryable_status(status_code: int) -> bool:
+    """Check whether an HTTP error status is transient and worth retrying"""
+    return status_code >= 500 or status_code in RETRYABLE_CLIENT_ERRORS
+
+
+# Longest Retry-After delay honoured; a server asking for more fails the call
+# rather than leaving the tool asleep
+MAX_RETRY_AFTER = 60.0
+
+# Statuses a provider may answer ``stream: true`` with when it does not support
+# streaming; the request is then repeated without it
+STREAM_UNSUPPORTED_STATUSES = frozenset({400, 422})
+
+# Receives each piece of streamed completion text as it arrives
+DeltaCallback = Callable[[str], Awaitable[None]]
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Parse a Retry-After header (seconds or HTTP date) into a delay in seconds"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=UTC)
+    return max(0.0, (retry_at - datetime.now(UTC)).total_seconds())
+
+
 async def call_glm_vision_api(
-    image_base64: str,
+    image_url: str,
     prompt: str,
-    mime_type: str = "image/jpeg",
     max_tokens: int = 2048,
     max_retries: int = 5,
     retry_delay: float = 2.0,
+    validated: bool = False,
+    cfg: GlmConfig | None = None,
+    on_delta: DeltaCallback | None = None,
 ) -> str:
-    """Call GLM-4.5V vision API for image analysis with retry logic"""
-    if not GLM_API_KEY:
-        raise ValueError("GLM_API_KEY environment variable not set")
+    """Call GLM-4.5V vision API for image analysis with retry logic
 
-    if not GLM_API_BASE:
-        raise ValueError("GLM_API_BASE environment variable not set")
+    Pass ``validated=True`` when the image URL was built from data known to
+    be valid base64, to skip re-checking the payload. ``cfg`` defaults to the
+    configuration read from the environment at import, which is validated
+    once when the server starts; the API key is still checked here, so a
+    direct call outside the server never sends an image without one.
 
-    # Validate base64 data
-    if not is_valid_base64(image_base64):
-        raise ValueError("Invalid base64 image data")
-
-    # Validate and normalize image format
-    mime_type = validate_image_format(mime_type)
+    The completion is streamed, and ``on_delta`` is awaited with each piece of
+    text as it arrives. If the provider rejects ``stream: true`` the request
+    is repeated once without it. A stream that fails after text has been
+    passed to ``on_delta`` is not retried, so no text is relayed twice.
+    """
+    cfg = cfg or _CFG
+    if not cfg.api_key:
+        raise ValueError("GLM_API_KEY environment variable not set")
 
-    headers = {
-        "Authorization": f"Bearer {GLM_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    # Validate the base64 payload in place, without slicing it out of the URL
+    if not validated:
+        separator = image_url.find(",")
+        if separator < 0 or not is_valid_base64(image_url, separator + 1):
+            raise ValueError("Invalid base64 image data")
 
     payload = {
-        "model": GLM_MODEL_NAME,
+        "model": cfg.model,
         "messages": [
             {
                 "role": "user",
@@ -162,7 +604,7 @@ async def call_glm_vision_api(
                     {"type": "text", "text": prompt},
                     {
                         "type": "image_url",
-                        "image_url": {"url": f"data:{mime_type};base64,{image_base64}"},
+                        "image_url": {"url": image_url},
                     },
                 ],
             }
@@ -171,23 +613,54 @@ async def call_glm_vision_api(
         "temperature": 0.7,
     }
 
+    # Serialize once with orjson; the base64 image dominates the body and the
+    # stdlib encoder would re-walk it in Python on every attempt
+    stream = True
+    body = orjson.dumps({**payload, "stream": True})
+
+    # Set once streamed text has been passed on; a retry would replay it
+    relayed = False
+    relay = None
+    if on_delta is not None:
+
+        async def relay(delta: str) -> None:
+            nonlocal relayed
+            relayed = True
+            await on_delta(delta)
+
+    client = _get_client()
     last_error = None
 
     for attempt in range(max_retries):
+        retry_after = None
         try:
-            async with httpx.AsyncClient(timeout=120.0) as client:
+            async with _get_semaphore():
+                await _rate_limiter.acquire()
+                if stream:
+                    async with client.stream(
+                        "POST", cfg.completions_url, headers=cfg.headers, content=body
+                    ) as response:
+                        if response.is_error:
+                            # Load the error body so it can be reported below
+                            await response.aread()
+                        if response.status_code in STREAM_UNSUPPORTED_STATUSES:
+                            stream = False
+                            body = orjson.dumps(payload)
+                        else:
+                            response.raise_for_status()
+                            return await read_completion_stream(response, relay)
                 response = await client.post(
-                    f"{GLM_API_BASE}/chat/completions", headers=headers, json=payload
+                    cfg.completions_url, headers=cfg.headers, content=body
                 )
-                response.raise_for_status()
+            response.raise_for_status()
 
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
+            result = orjson.loads(response.content)
+            return cast(str, result["choices"][0]["message"]["content"])
 
         except httpx.HTTPStatusError as e:
             error_msg = f"GLM API error: {e.response.status_code}"
             try:
-                error_detail = e.response.json()
+                error_detail = orjson.loads(e.response.content)
                 error_msg += (
                     f" - {error_detail.get('error', {}).get('message', 'Unknown')}"
                     f" error"
@@ -195,24 +668,44 @@ async def call_glm_vision_api(
             except Exception:
                 error_msg += f" - {e.response.text}"
 
-            last_error = RuntimeError(error_msg)
+            # Permanent failures (e.g. 400/401/403) fail fast instead of
+            # sleeping through every backoff step first
+            if not is_retryable_status(e.response.status_code):
+                raise RuntimeError(error_msg) from None
 
-            # Don't retry on authentication errors or certain HTTP status codes
-            if e.response.status_code in (401, 403, 429):
-                break
+            retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                raise RuntimeError(
+                    f"{error_msg} (retry after {retry_after:.0f}s)"
+                ) from None
+            last_error = RuntimeError(error_msg)
 
         except httpx.TimeoutException as e:
             last_error = RuntimeError(f"GLM API timeout: {e}")
-        except httpx.NetworkError as e:
+            last_error.__cause__ = e
+        except (httpx.NetworkError, httpx.RemoteProtocolError) as e:
+            # A peer dropping a reused keep-alive or HTTP/2 connection shows up
+            # as a protocol error and is as transient as a network failure
             last_error = RuntimeError(f"GLM API network error: {e}")
-        except Exception as e:
-            error_details = f"Failed to call GLM API: {str(e)}\
-            Traceback: {traceback.format_exc()}"
-            last_error = RuntimeError(error_details)
+            last_error.__cause__ = e
+        except (httpx.HTTPError, KeyError, IndexError, TypeError, ValueError) as e:
+            # Chain the cause rather than formatting a traceback here; it is
+            # logged once, only if the failure reaches the tool
+            raise RuntimeError(f"Failed to call GLM API: {e!r}") from e
+
+        # Part of the completion already reached the caller; a retry would
+        # send it again, and a fresh sample may not even begin the same way
+        if relayed and last_error is not None:
+            raise last_error
 
         # If this is not the last attempt, wait before retrying
         if attempt < max_retries - 1:
-            await asyncio.sleep(retry_delay * (2**attempt))  # Exponential backoff
+            # Exponential backoff with jitter so concurrent callers don't retry
+            # in lockstep, never sooner than the server asked us to wait
+            delay = retry_delay * (2**attempt) * random.uniform(0.5, 1.5)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            await asyncio.sleep(delay)
 
     # All retries failed, raise the last error
     if last_error:
@@ -221,6 +714,223 @@ async def call_glm_vision_api(
         raise RuntimeError("Failed to call GLM API after maximum retries")
 
 
+async def read_completion_stream(
+    response: httpx.Response, on_delta: DeltaCallback | None = None
+) -> str:
+    """Accumulate the text of a streamed chat completion
+
+    Reads the server-sent events line by line, so only the text collected so
+    far is held in memory. A provider that ignores ``stream: true`` and sends
+    a plain JSON completion is handled too. An error event, or a stream that
+    ends without any text, raises RuntimeError rather than returning "".
+    """
+    if not response.headers.get("content-type", "").startswith("text/event-stream"):
+        await response.aread()
+        completion = orjson.loads(response.content)
+        return cast(str, completion["choices"][0]["message"]["content"])
+
+    parts: list[str] = []
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if data == "[DONE]":
+            break
+        event = orjson.loads(data)
+        # Providers may report a failure mid-stream after a 200 status
+        if "error" in event:
+            error = event["error"]
+            message = (
+                error.get("message", "Unknown") if isinstance(error, dict) else error
+            )
+            raise RuntimeError(f"GLM API error: {message}")
+        choices = event.get("choices")
+        if not choices:
+            continue
+        delta = (choices[0].get("delta") or {}).get("content")
+        if delta:
+            parts.append(delta)
+            if on_delta is not None:
+                await on_delta(delta)
+    if not parts:
+        raise RuntimeError("GLM API returned an empty completion")
+    return "".join(parts)
+
+
+# Characters of an image data URL encoded and hashed at a time for cache keys
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class ResponseCache:
+    """In-memory LRU cache of analysis results
+
+    Entries are keyed on the image content, the user context, the token limit
+    and the model name, so repeated questions about the same image are answered
+    without another round-trip to the vision API. A ``max_size`` of 0 disables
+    caching. All operations are synchronous, so they are atomic with respect to
+    the event loop and need no lock.
+    """
+
+    def __init__(self, max_size: int = 512) -> None:
+        self.max_size = max_size
+        self._entries: OrderedDict[str, str] = OrderedDict()
+
+    @staticmethod
+    def make_key(image_url: str, user_context: str, max_tokens: int) -> str:
+        """Build a cache key for an analysis request
+
+        Hashing a multi-megabyte image takes a while, so call this in a worker
+        thread rather than on the event loop.
+        """
+        # Encode a slice at a time rather than copying the whole data URL
+        image_hash = hashlib.sha256()
+        for start in range(0, len(image_url), HASH_CHUNK_SIZE):
+            image_hash.update(image_url[start : start + HASH_CHUNK_SIZE].encode())
+        image_digest = image_hash.hexdigest()
+        context_digest = hashlib.sha256(user_context.encode()).hexdigest()
+        return f"{_CFG.model}:{max_tokens}:{image_digest}:{context_digest}"
+
+    def get(self, key: str) -> str | None:
+        """Return the cached result for a key, or None on a miss"""
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: str) -> None:
+        """Store a result, evicting the least recently used entry when full
+
+        Empty results are not stored, so a failed completion is asked again
+        rather than served from the cache.
+        """
+        if self.max_size <= 0 or not result:
+            return
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop all cached results"""
+        self._entries.clear()
+
+
+_response_cache = ResponseCache(VISUAL_MCP_CACHE_SIZE)
+
+
+# (image_url, prompt, max_tokens, validated) for a single GLM call
+CallKey = tuple[str, str, int, bool]
+
+
+@dataclass(slots=True)
+class _Flight:
+    """An upstream GLM call and the callers waiting on it"""
+
+    waiters: list[asyncio.Future[str]] = field(default_factory=list)
+    listeners: list[DeltaCallback] = field(default_factory=list)
+    task: asyncio.Task[None] | None = None
+
+
+class SingleFlight:
+    """Share one upstream call between identical concurrent GLM requests
+
+    While a call for a request is in flight, identical requests wait on it
+    instead of starting their own; nothing is held back waiting for others to
+    arrive. Streamed text is relayed to every caller that has joined so far; a
+    caller whose callback fails, or who is cancelled, stops receiving it
+    without affecting the others.
+    """
+
+    def __init__(self) -> None:
+        self._flights: dict[CallKey, _Flight] = {}
+
+    async def process(
+        self,
+        image_url: str,
+        prompt: str,
+        max_tokens: int,
+        validated: bool = False,
+        on_delta: DeltaCallback | None = None,
+    ) -> str:
+        """Start or join the call for a request and wait for its result"""
+        loop = asyncio.get_running_loop()
+        key = (image_url, prompt, max_tokens, validated)
+        flight = self._flights.get(key)
+        # A flight left over from another event loop can't be joined
+        if flight is None or flight.task is None or flight.task.get_loop() is not loop:
+            flight = _Flight()
+            self._flights[key] = flight
+            flight.task = loop.create_task(self._run(key, flight))
+
+        future: asyncio.Future[str] = loop.create_future()
+        flight.waiters.append(future)
+        if on_delta is not None:
+            flight.listeners.append(on_delta)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # A caller that has gone away no longer wants the streamed text
+            if on_delta is not None and on_delta in flight.listeners:
+                flight.listeners.remove(on_delta)
+            raise
+
+    async def _run(self, key: CallKey, flight: _Flight) -> None:
+        """Make the upstream call and hand its outcome to every waiter"""
+        image_url, prompt, max_tokens, validated = key
+
+        async def relay(delta: str) -> None:
+            for callback in list(flight.listeners):
+                try:
+                    await callback(delta)
+                except Exception:
+                    # One caller's failure (e.g. a disconnected client) must
+                    # not abort the call the other callers are sharing
+                    logger.warning("Dropping failed stream listener", exc_info=True)
+                    if callback in flight.listeners:
+                        flight.listeners.remove(callback)
+
+        outcome: str | BaseException
+        try:
+            outcome = await call_glm_vision_api(
+                image_url, prompt, max_tokens, validated=validated, on_delta=relay
+            )
+        except Exception as e:
+            outcome = e
+        finally:
+            # Identical requests arriving from now on start a fresh call
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+        for future in flight.waiters:
+            if future.done():
+                continue
+            if isinstance(outcome, BaseException):
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    async def aclose(self) -> None:
+        """Cancel the upstream calls still in flight, failing their waiters"""
+        loop = asyncio.get_running_loop()
+        flights = list(self._flights.values())
+        self._flights.clear()
+
+        tasks = []
+        for flight in flights:
+            for future in flight.waiters:
+                if not future.done():
+                    future.set_exception(
+                        RuntimeError("GLM API call cancelled: server shutting down")
+                    )
+            if flight.task is not None and flight.task.get_loop() is loop:
+                flight.task.cancel()
+                tasks.append(flight.task)
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+_single_flight = SingleFlight()
+
+
 @mcp.tool()
 async def analyze_image_with_context(
     image_data: str,
@@ -247,39 +957,52 @@ async def analyze_image_with_context(
 
     Returns:
         Comprehensive analysis tailored to your specific needs
+
+    Raises:
+        McpError: If the image is invalid (INVALID_PARAMS) or the analysis
+            fails (INTERNAL_ERROR)
     """
     try:
         if ctx:
             await ctx.info("Starting image analysis with context...")
 
-        # Prepare image data and detect format
-        image_base64, mime_type = prepare_image_for_api(image_data)
+        # Prepare image data as a data URL with a detected format
+        image_url, validated = await prepare_image_for_api(image_data)
+
+        # Serve repeated questions about the same image from the cache
+        cache_key = await asyncio.to_thread(
+            _response_cache.make_key, image_url, user_context, max_tokens
+        )
+        cached_result = _response_cache.get(cache_key)
+        if cached_result is not None:
+            if ctx:
+                await ctx.info("Returning cached image analysis")
+            return cached_result
 
         # Build an enhanced prompt that guides the AI to provide the right
         # type of analysis
-        enhanced_prompt = f"""
-You are a comprehensive visual analysis assistant. The user has provided
-        an image and specific context about what they need.
+        enhanced_prompt = PROMPT_PREFIX + user_context
 
-USER CONTEXT: {user_context}
-
-Based on this context, provide the most appropriate analysis which may include:
-- Detailed description of visual elements
-- Text extraction and transcription (if text is present)
-- Diagram/technical analysis (if it's a diagram, chart, or technical drawing)
-- Summary of key information
-- Identification of issues, patterns, or insights
-- Step-by-step explanations when appropriate
+        # Relay the streamed analysis to the client a line at a time, rather
+        # than one notification per token
+        on_delta = None
+        if ctx:
+            pending: list[str] = []
 
-Adapt your response style and focus based on what the user is asking for.
-Be thorough but concise.
-"""
+            async def on_delta(delta: str) -> None:
+                pending.append(delta)
+                if "\n" in delta:
+                    await ctx.info("".join(pending))
+                    pending.clear()
 
-        # Call GLM vision API with retry logic
-        result = await call_glm_vision_api(
-            image_base64, enhanced_prompt, mime_type, max_tokens
+        # Call GLM vision API with retry logic, sharing the call with any
+        # identical request already in flight
+        result = await _single_flight.process(
+            image_url, enhanced_prompt, max_tokens, validated, on_delta
         )
 
+        _response_cache.put(cache_key, result)
+
         if ctx:
             await ctx.info("Image analysis completed successfully")
 
@@ -287,13 +1010,26 @@ Be thorough but concise.
 
     except Exception as e:
         error_msg = f"Image analysis failed: {str(e)}"
+        logger.exception(error_msg)
         if ctx:
             await ctx.error(error_msg)
-        return error_msg
+        # Bad input is the caller's to fix; anything else is a server failure
+        code = INVALID_PARAMS if isinstance(e, ValueError) else INTERNAL_ERROR
+        raise McpError(ErrorData(code=code, message=error_msg)) from e
+
+
+def install_uvloop() -> None:
+    """Use uvloop for the asyncio event loop when it is installed"""
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
-def main():
+def main() -> None:
     """Main entry point for the MCP server"""
+    install_uvloop()
     mcp.run()
 
 
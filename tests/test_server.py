@@ -7,174 +7,736 @@ based on the user's natural language context, eliminating the need for multiple
 specialized tools.
 """
 
+import asyncio
 import base64
+import hashlib
+import io
 import os
-import tempfile
 from unittest.mock import AsyncMock, MagicMock, patch
 
+import httpx
+import orjson
 import pytest
+import respx
+from mcp.server.fastmcp import Context
+from mcp.shared.exceptions import McpError
+from mcp.types import INTERNAL_ERROR, INVALID_PARAMS
 
 # Import the server functions
 from visual_mcp.server import (
+    PROMPT_PREFIX,
+    GlmConfig,
+    RateLimiter,
+    ResponseCache,
+    SingleFlight,
+    _get_client,
+    _get_semaphore,
+    _lifespan,
+    _mime_for_ext,
+    _response_cache,
     analyze_image_with_context,
     call_glm_vision_api,
+    downscale_image,
     encode_file_to_base64,
+    install_uvloop,
+    is_retryable_status,
+    is_valid_base64,
+    mcp,
+    parse_retry_after,
     prepare_image_for_api,
+    sniff_image_mime_type,
+    validate_image_format,
 )
 
+TEST_CONFIG = GlmConfig(
+    api_key="test-api-key", api_base="https://glm.test", model="glm-4.5v"
+)
+
+# Minimal JPEG: SOI, JFIF APP0 header, truncated DQT marker and EOI
+JPEG_STUB = bytes.fromhex("ffd8ffe000104a46494600010101004800480000ffdb004300ffd9")
+
+
+def completion_stream(*deltas: str) -> httpx.Response:
+    """Build a streamed chat completion response sending ``deltas`` in order"""
+    events = [
+        b"data: " + orjson.dumps({"choices": [{"delta": {"content": delta}}]})
+        for delta in deltas
+    ]
+    events.append(b"data: [DONE]")
+    return httpx.Response(
+        200,
+        headers={"content-type": "text/event-stream"},
+        content=b"\n\n".join(events) + b"\n\n",
+    )
+
+
+@pytest.fixture
+async def glm_api():
+    """Serve the chat completions endpoint from respx and return its route
+
+    The real shared client is used, created fresh for TEST_CONFIG, so requests
+    run through httpx end to end.
+    """
+    with (
+        patch("visual_mcp.server._CFG", TEST_CONFIG),
+        patch("visual_mcp.server._client", None),
+        respx.mock(base_url=TEST_CONFIG.api_base) as router,
+    ):
+        yield router.post("/chat/completions")
+        await _get_client().aclose()
+
+
+@pytest.fixture(scope="session")
+def sample_jpeg_path(tmp_path_factory):
+    """Write a minimal JPEG once for every test that reads one from disk"""
+    path = tmp_path_factory.mktemp("img") / "sample.jpg"
+    path.write_bytes(JPEG_STUB)
+    return str(path)
+
+
+@pytest.fixture
+def mock_ctx():
+    """Stand in for the MCP context
+
+    Specced on Context, so its coroutine methods (info, error, ...) are
+    AsyncMocks and attributes the real context lacks raise AttributeError.
+    """
+    return MagicMock(spec=Context)
+
+
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    """Keep cached analysis results from leaking between tests"""
+    _response_cache.clear()
+    yield
+    _response_cache.clear()
+
 
 class TestImageEncoding:
     """Test image encoding utilities"""
 
-    def test_encode_file_to_base64_file_exists(self):
+    def test_encode_file_to_base64_file_exists(self, sample_jpeg_path):
         """Test encoding existing file"""
-        # Create a temporary image file
-        with tempfile.NamedTemporaryFile(mode="wb", suffix=".jpg", delete=False) as tmp:
-            # Write minimal JPEG header
-            tmp.write(
-                b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01\x01\x01\x00H\x00H\x00\x00\xff\xdb\x00C\x00\xff\xd9"
-            )
-            tmp_path = tmp.name
+        result, mime_type = encode_file_to_base64(sample_jpeg_path)
+        assert isinstance(result, str)
+        assert isinstance(mime_type, str)
+        assert len(result) > 0
+        assert mime_type == "image/jpeg"
+        # Should be valid base64
+        decoded = base64.b64decode(result)
+        assert len(decoded) > 0
 
-        try:
-            result, mime_type = encode_file_to_base64(tmp_path)
-            assert isinstance(result, str)
-            assert isinstance(mime_type, str)
-            assert len(result) > 0
-            assert mime_type == "image/jpeg"
-            # Should be valid base64
-            decoded = base64.b64decode(result)
-            assert len(decoded) > 0
-        finally:
-            os.unlink(tmp_path)
+    def test_encode_file_to_base64_file_object(self):
+        """Test encoding an in-memory binary file"""
+        image = io.BytesIO(b"fake_png_data")
+        image.name = "chart.png"
+        result, mime_type = encode_file_to_base64(image)
+        assert base64.b64decode(result) == b"fake_png_data"
+        assert mime_type == "image/png"
+
+        # Without a name there is no extension to go on
+        result, mime_type = encode_file_to_base64(io.BytesIO(b"fake_image_data"))
+        assert base64.b64decode(result) == b"fake_image_data"
+        assert mime_type == "image/jpeg"
 
     def test_encode_file_to_base64_file_not_exists(self):
         """Test encoding non-existent file raises error"""
         with pytest.raises(ValueError, match="File not found"):
             encode_file_to_base64("/non/existent/file.txt")
 
-    def test_prepare_image_for_api_file_path(self):
-        """Test preparing image from file path"""
-        with tempfile.NamedTemporaryFile(suffix=".jpg", delete=False) as tmp:
-            # Write some test data
-            tmp.write(b"fake_image_data")
-            tmp.flush()
+    def test_is_valid_base64(self):
+        """Test base64 validation accepts padded and unpadded data"""
+        assert is_valid_base64("ZmFrZV9pbWFnZV9kYXRh")
+        assert is_valid_base64("dGVzdF9kYXRh")
+        assert is_valid_base64("dGVzdA==")
+        assert is_valid_base64("dGVzdA")
 
-            try:
-                result, mime_type = prepare_image_for_api(tmp.name)
-                assert isinstance(result, str)
-                assert isinstance(mime_type, str)
-                assert len(result) > 0
-                assert mime_type == "image/jpeg"
-                # Should be base64 without data URL prefix
-                assert not result.startswith("data:")
-            finally:
-                os.unlink(tmp.name)
+    def test_is_valid_base64_invalid(self):
+        """Test base64 validation rejects malformed data"""
+        assert not is_valid_base64("not base64!")
+        assert not is_valid_base64("dGVzd")  # dangling single character
+        assert not is_valid_base64("dGVzdA=")  # incomplete padding
+        assert not is_valid_base64("dGVz=ZA==")  # padding in the middle
+
+    def test_encode_file_to_base64_empty_file(self, tmp_path):
+        """Test encoding an empty file returns empty data"""
+        path = tmp_path / "empty.png"
+        path.touch()
 
-    def test_prepare_image_for_api_base64_with_url(self):
+        result, mime_type = encode_file_to_base64(str(path))
+        assert result == ""
+        assert mime_type == "image/png"
+
+    async def test_prepare_image_for_api_file_path(self, sample_jpeg_path):
+        """Test preparing image from file path"""
+        result, validated = await prepare_image_for_api(sample_jpeg_path)
+        assert validated  # Encoded by us, so known-valid
+        assert isinstance(result, str)
+        # Should be a complete data URL with the detected mime type
+        assert result.startswith("data:image/jpeg;base64,")
+        encoded = result.split(",", 1)[1]
+        assert base64.b64decode(encoded) == JPEG_STUB
+
+    async def test_prepare_image_for_api_base64_with_url(self):
         """Test preparing image from data URL"""
         data_url = "data:image/png;base64,ZmFrZV9pbWFnZV9kYXRh"
-        result, mime_type = prepare_image_for_api(data_url)
-        assert result == "ZmFrZV9pbWFnZV9kYXRh"
-        assert mime_type == "image/png"
+        result, validated = await prepare_image_for_api(data_url)
+        assert not validated
+        # Supported data URLs are forwarded unchanged
+        assert result is data_url
+
+    async def test_prepare_image_for_api_data_url_unsupported_format(self):
+        """Test data URLs with unsupported formats are normalized"""
+        data_url = "data:image/bmp;base64,ZmFrZV9pbWFnZV9kYXRh"
+        result, _ = await prepare_image_for_api(data_url)
+        assert result == "data:image/jpeg;base64,ZmFrZV9pbWFnZV9kYXRh"
 
-    def test_prepare_image_for_api_base64_only(self):
+    async def test_prepare_image_for_api_base64_only(self):
         """Test preparing image from base64 only"""
         base64_data = "ZmFrZV9pbWFnZV9kYXRh"
-        result, mime_type = prepare_image_for_api(base64_data)
-        assert result == base64_data
-        assert mime_type == "image/jpeg"  # Default fallback
+        result, validated = await prepare_image_for_api(base64_data)
+        assert validated  # Raw base64 is checked while it is classified
+        assert result == f"data:image/jpeg;base64,{base64_data}"  # Default fallback
 
+    async def test_prepare_image_for_api_rejects_invalid_raw_input(self):
+        """Test input that is not a file, data URL or base64 fails early"""
+        with pytest.raises(ValueError, match="not an existing file"):
+            await prepare_image_for_api("/no/such/image.png")
 
-class TestGLMAPI:
-    """Test GLM API integration"""
+    async def test_prepare_image_for_api_detects_png_base64(self):
+        """Test raw base64 PNG data is labelled as PNG"""
+        png_base64 = base64.b64encode(b"\x89PNG\r\n\x1a\nfake_png_data").decode()
+        result, _ = await prepare_image_for_api(png_base64)
+        assert result == f"data:image/png;base64,{png_base64}"
 
-    @pytest.mark.asyncio
-    @patch("visual_mcp.server.httpx.AsyncClient")
-    @patch("visual_mcp.server.GLM_API_KEY", "test-api-key")
-    @patch("visual_mcp.server.GLM_MODEL_NAME", "glm-4.5v")
-    async def test_call_glm_vision_api_success(self, mock_client):
-        """Test successful GLM vision API call"""
-        # Mock the HTTP client response
-        mock_response = MagicMock()
-        mock_response.raise_for_status.return_value = None
-        mock_response.json.return_value = {
-            "choices": [{"message": {"content": "This is a test analysis response"}}]
+    async def test_prepare_image_for_api_relabels_mislabelled_data_url(self):
+        """Test data URLs are labelled by their content, not their header"""
+        png_base64 = base64.b64encode(b"\x89PNG\r\n\x1a\nfake_png_data").decode()
+        result, _ = await prepare_image_for_api(f"data:image/jpeg;base64,{png_base64}")
+        assert result == f"data:image/png;base64,{png_base64}"
+
+    async def test_prepare_image_for_api_data_url_with_parameters(self):
+        """Test data URLs with extra parameters before ;base64 are accepted"""
+        data_url = "data:image/png;name=chart.png;base64,ZmFrZV9pbWFnZV9kYXRh"
+        result, _ = await prepare_image_for_api(data_url)
+        assert result is data_url
+
+    async def test_prepare_image_for_api_invalid_data_url(self):
+        """Test malformed data URLs raise a clear error"""
+        with pytest.raises(ValueError, match="Invalid data URL"):
+            await prepare_image_for_api("data:image/png,not-base64")
+
+    async def test_prepare_image_for_api_data_url_scheme_is_case_insensitive(self):
+        """Test the data URL scheme and type are matched case-insensitively"""
+        result, _ = await prepare_image_for_api(
+            "DATA:IMAGE/PNG;BASE64,ZmFrZV9pbWFnZV9kYXRh"
+        )
+        assert result == "data:image/png;base64,ZmFrZV9pbWFnZV9kYXRh"
+
+    def test_validate_image_format(self):
+        """Test mime types are normalized to a supported format"""
+        assert validate_image_format("image/png") == "image/png"
+        assert validate_image_format("IMAGE/PNG") == "image/png"
+        assert validate_image_format("image/jpg") == "image/jpg"
+        assert validate_image_format("image/bmp") == "image/jpeg"
+
+    def test_sniff_image_mime_type(self):
+        """Test format detection from magic bytes"""
+        signatures = {
+            b"\x89PNG\r\n\x1a\n\x00\x00\x00\x0d": "image/png",
+            b"\xff\xd8\xff\xe0\x00\x10JFIF\x00\x01": "image/jpeg",
+            b"RIFF\x24\x00\x00\x00WEBPVP8 ": "image/webp",
+            b"GIF89a\x01\x00\x01\x00\x00\x00": "image/gif",
         }
+        for header, expected in signatures.items():
+            assert sniff_image_mime_type(base64.b64encode(header).decode()) == expected
+
+        assert sniff_image_mime_type("ZmFrZV9pbWFnZV9kYXRh") is None
+        assert sniff_image_mime_type("not base64!") is None
+
+    def test_mime_for_ext(self):
+        """Test file extensions map to image mime types, defaulting to JPEG"""
+        assert _mime_for_ext(".png") == "image/png"
+        assert _mime_for_ext(".jpg") == "image/jpeg"
+        assert _mime_for_ext(".txt") == "image/jpeg"
+        assert _mime_for_ext("") == "image/jpeg"
 
-        mock_client.return_value.__aenter__.return_value.post.return_value = (
-            mock_response
+    @patch("visual_mcp.server.os.path.exists")
+    async def test_prepare_image_for_api_skips_path_check_for_long_input(
+        self, mock_exists
+    ):
+        """Test long base64 inputs are never probed as file paths"""
+        base64_data = "A" * 8192
+        result, _ = await prepare_image_for_api(base64_data)
+        assert result == f"data:image/jpeg;base64,{base64_data}"
+        mock_exists.assert_not_called()
+
+
+class TestDownscaling:
+    """Test downscaling of oversized images before upload"""
+
+    @staticmethod
+    def make_noisy_png(width: int, height: int) -> bytes:
+        """Create a PNG that compresses poorly, so it exceeds the size threshold"""
+        image_module = pytest.importorskip("PIL.Image")
+        image = image_module.frombytes(
+            "RGB", (width, height), os.urandom(width * height * 3)
         )
+        output = io.BytesIO()
+        image.save(output, format="PNG")
+        return output.getvalue()
+
+    @patch("visual_mcp.server.VISUAL_MCP_MAX_EDGE", 600)
+    def test_downscale_image_applies_exif_orientation(self):
+        """Test sideways-stored photos come out upright after downscaling"""
+        image_module = pytest.importorskip("PIL.Image")
+        image = image_module.frombytes("RGB", (1200, 800), os.urandom(1200 * 800 * 3))
+        exif = image_module.Exif()
+        exif[0x0112] = 6  # Orientation: rotate 90 degrees clockwise to display
+        output = io.BytesIO()
+        image.save(output, format="JPEG", quality=95, exif=exif)
+
+        resized, mime_type = downscale_image(output.getvalue())
+
+        assert mime_type == "image/jpeg"
+        with image_module.open(io.BytesIO(resized)) as result:
+            assert result.size == (400, 600)
+
+    @patch("visual_mcp.server.VISUAL_MCP_MAX_EDGE", 256)
+    def test_encode_file_to_base64_downscales_large_image(self, tmp_path):
+        """Test large image files are resized and re-encoded as JPEG"""
+        image_module = pytest.importorskip("PIL.Image")
+        path = tmp_path / "large.png"
+        path.write_bytes(self.make_noisy_png(800, 400))
+
+        result, mime_type = encode_file_to_base64(str(path))
+
+        assert mime_type == "image/jpeg"
+        with image_module.open(io.BytesIO(base64.b64decode(result))) as image:
+            assert image.size == (256, 128)
+
+    @patch("visual_mcp.server.VISUAL_MCP_MAX_EDGE", 256)
+    async def test_prepare_image_for_api_downscales_large_data_url(self):
+        """Test large base64 data URLs are resized before upload"""
+        png_bytes = self.make_noisy_png(800, 400)
+        data_url = "data:image/png;base64," + base64.b64encode(png_bytes).decode()
+
+        result, validated = await prepare_image_for_api(data_url)
+
+        assert validated
+        assert result.startswith("data:image/jpeg;base64,")
+        assert len(result) < len(data_url)
+
+    @patch("visual_mcp.server.VISUAL_MCP_MAX_EDGE", 0)
+    async def test_prepare_image_for_api_downscaling_disabled(self):
+        """Test a max edge of 0 leaves large images untouched"""
+        png_bytes = self.make_noisy_png(800, 400)
+        data_url = "data:image/png;base64," + base64.b64encode(png_bytes).decode()
+
+        result, validated = await prepare_image_for_api(data_url)
+
+        assert not validated
+        assert result is data_url
+
+
+class TestGLMAPI:
+    """Test GLM API integration"""
+
+    async def test_call_glm_vision_api_success(self, glm_api):
+        """Test successful GLM vision API call"""
+        glm_api.return_value = completion_stream("This is a test ", "analysis response")
 
         # Test the API call
         result = await call_glm_vision_api(
-            "dGVzdF9iYXNlNjRfaW1hZ2VfZGF0YQ==", "Test prompt", max_tokens=1000
+            "data:image/png;base64,dGVzdF9iYXNlNjRfaW1hZ2VfZGF0YQ==",
+            "Test prompt",
+            max_tokens=1000,
         )
 
         assert result == "This is a test analysis response"
 
         # Verify the API call was made correctly
-        mock_client.return_value.__aenter__.return_value.post.assert_called_once()
-        call_args = mock_client.return_value.__aenter__.return_value.post.call_args
-
-        assert call_args[1]["json"]["model"] == "glm-4.5v"
-        assert call_args[1]["json"]["max_tokens"] == 1000
-        assert len(call_args[1]["json"]["messages"]) == 1
-        assert call_args[1]["json"]["messages"][0]["role"] == "user"
-
-    @pytest.mark.asyncio
-    @patch("visual_mcp.server.httpx.AsyncClient")
-    @patch("visual_mcp.server.GLM_API_KEY", "test-api-key")
-    async def test_call_glm_vision_api_http_error(self, mock_client):
-        """Test GLM vision API call with HTTP error"""
-        # Mock HTTP error
-        mock_response = MagicMock()
-        mock_response.raise_for_status.side_effect = Exception("HTTP 404")
-        mock_response.json.return_value = {"error": {"message": "Not found"}}
+        assert glm_api.call_count == 1
+        request = glm_api.calls.last.request
+        assert request.headers["Authorization"] == "Bearer test-api-key"
 
-        mock_client.return_value.__aenter__.return_value.post.return_value = (
-            mock_response
+        payload = orjson.loads(request.content)
+        assert payload["stream"] is True
+        assert payload["model"] == "glm-4.5v"
+        assert payload["max_tokens"] == 1000
+        assert len(payload["messages"]) == 1
+        assert payload["messages"][0]["role"] == "user"
+        image_part = payload["messages"][0]["content"][1]
+        assert image_part["image_url"]["url"] == (
+            "data:image/png;base64,dGVzdF9iYXNlNjRfaW1hZ2VfZGF0YQ=="
         )
 
+    async def test_call_glm_vision_api_uses_given_config(self):
+        """Test a non-default config supplies the URL as well as key and model"""
+        other = GlmConfig(
+            api_key="other-key", api_base="https://other.test/v1", model="other-model"
+        )
+        with (
+            patch("visual_mcp.server._CFG", TEST_CONFIG),
+            patch("visual_mcp.server._client", None),
+            respx.mock(assert_all_called=False) as router,
+        ):
+            default_api = router.post(f"{TEST_CONFIG.api_base}/chat/completions")
+            other_api = router.post("https://other.test/v1/chat/completions").mock(
+                return_value=completion_stream("Other analysis")
+            )
+            try:
+                result = await call_glm_vision_api(
+                    "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt", cfg=other
+                )
+            finally:
+                await _get_client().aclose()
+
+        assert result == "Other analysis"
+        assert not default_api.called
+        request = other_api.calls.last.request
+        assert request.headers["Authorization"] == "Bearer other-key"
+        assert orjson.loads(request.content)["model"] == "other-model"
+
+    async def test_call_glm_vision_api_requires_api_key(self):
+        """Test nothing is sent when no API key is configured"""
+        no_key = GlmConfig(api_key="", api_base=TEST_CONFIG.api_base, model="glm")
+
+        with (
+            patch("visual_mcp.server._client", None),
+            respx.mock(assert_all_called=False) as router,
+        ):
+            api = router.post(no_key.completions_url)
+            with pytest.raises(ValueError, match="GLM_API_KEY"):
+                await call_glm_vision_api(
+                    "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt", cfg=no_key
+                )
+
+        assert not api.called
+
+    async def test_call_glm_vision_api_http_error(self, glm_api):
+        """Test GLM vision API call with HTTP error"""
+        glm_api.side_effect = httpx.HTTPError("HTTP 404")
+
         # Test the API call handles error
         with pytest.raises(RuntimeError, match="Failed to call GLM API"):
-            await call_glm_vision_api("dGVzdF9kYXRh", "test prompt")
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+            )
+
+    @patch("visual_mcp.server.is_valid_base64")
+    async def test_call_glm_vision_api_skips_validation_when_validated(
+        self, mock_is_valid, glm_api
+    ):
+        """Test already-validated image data is not checked again"""
+        glm_api.return_value = completion_stream("Analysis")
+
+        result = await call_glm_vision_api(
+            "data:image/png;base64,dGVzdF9kYXRh", "test prompt", validated=True
+        )
+
+        assert result == "Analysis"
+        mock_is_valid.assert_not_called()
+
+    async def test_call_glm_vision_api_malformed_response(self, glm_api):
+        """Test GLM vision API call with a response missing the choices"""
+        glm_api.return_value = httpx.Response(200, json={"unexpected": "shape"})
+
+        with pytest.raises(RuntimeError, match="Failed to call GLM API") as exc:
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+            )
+
+        # The original error is chained instead of formatted into the message
+        assert isinstance(exc.value.__cause__, KeyError)
+        assert "Traceback" not in str(exc.value)
+        assert glm_api.call_count == 1
+
+    async def test_call_glm_vision_api_relays_streamed_text(self, glm_api):
+        """Test each streamed delta is passed on as it arrives"""
+        glm_api.return_value = completion_stream("Line one\n", "Line two")
+        on_delta = AsyncMock()
+
+        result = await call_glm_vision_api(
+            "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt", on_delta=on_delta
+        )
+
+        assert result == "Line one\nLine two"
+        assert [c.args[0] for c in on_delta.await_args_list] == [
+            "Line one\n",
+            "Line two",
+        ]
+
+    async def test_call_glm_vision_api_raises_on_streamed_error(self, glm_api):
+        """Test an error event sent with a 200 status fails the call"""
+        glm_api.return_value = httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            content=b'data: {"error": {"message": "Upstream overloaded"}}\n\n',
+        )
+
+        with pytest.raises(RuntimeError, match="Upstream overloaded"):
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+            )
+        assert glm_api.call_count == 1
+
+    async def test_call_glm_vision_api_raises_on_empty_stream(self, glm_api):
+        """Test a stream that ends without any text fails the call"""
+        glm_api.return_value = completion_stream()
+
+        with pytest.raises(RuntimeError, match="empty completion"):
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+            )
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_call_glm_vision_api_does_not_replay_relayed_text(
+        self, mock_sleep, glm_api
+    ):
+        """Test a stream dropped after relaying text is not retried"""
+
+        class DroppedStream(httpx.AsyncByteStream):
+            async def __aiter__(self):
+                yield b'data: {"choices": [{"delta": {"content": "Hello\\n"}}]}\n\n'
+                raise httpx.ReadError("Connection dropped")
+
+        glm_api.side_effect = [
+            httpx.Response(
+                200,
+                headers={"content-type": "text/event-stream"},
+                stream=DroppedStream(),
+            ),
+            completion_stream("Hello\n", "World"),
+        ]
+        on_delta = AsyncMock()
+
+        with pytest.raises(RuntimeError, match="network error"):
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt", on_delta=on_delta
+            )
+
+        on_delta.assert_awaited_once_with("Hello\n")
+        assert glm_api.call_count == 1
+        mock_sleep.assert_not_awaited()
+
+    async def test_call_glm_vision_api_falls_back_without_streaming(self, glm_api):
+        """Test a provider rejecting stream=true is asked again without it"""
+        glm_api.side_effect = [
+            httpx.Response(400, json={"error": {"message": "stream not supported"}}),
+            httpx.Response(
+                200, json={"choices": [{"message": {"content": "Buffered"}}]}
+            ),
+        ]
+
+        result = await call_glm_vision_api(
+            "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+        )
+
+        assert result == "Buffered"
+        assert glm_api.call_count == 2
+        payload = orjson.loads(glm_api.calls.last.request.content)
+        assert "stream" not in payload
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_call_glm_vision_api_retries_server_errors(self, mock_sleep, glm_api):
+        """Test GLM vision API call retries 5xx responses"""
+        glm_api.side_effect = [
+            httpx.Response(503, json={}),
+            completion_stream("Recovered"),
+        ]
+
+        result = await call_glm_vision_api(
+            "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+        )
+
+        assert result == "Recovered"
+        assert glm_api.call_count == 2
+        mock_sleep.assert_awaited_once()
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_call_glm_vision_api_retries_dropped_connections(
+        self, mock_sleep, glm_api
+    ):
+        """Test a connection dropped by the server is retried"""
+        glm_api.side_effect = [
+            httpx.RemoteProtocolError("Server disconnected"),
+            completion_stream("Recovered"),
+        ]
+
+        result = await call_glm_vision_api(
+            "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+        )
+
+        assert result == "Recovered"
+        assert glm_api.call_count == 2
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_call_glm_vision_api_does_not_retry_client_errors(
+        self, mock_sleep, glm_api
+    ):
+        """Test GLM vision API call fails fast on 4xx responses"""
+        glm_api.return_value = httpx.Response(
+            403, json={"error": {"message": "Forbidden"}}
+        )
+
+        with pytest.raises(RuntimeError, match="GLM API error: 403 - Forbidden"):
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+            )
+
+        assert glm_api.call_count == 1
+        mock_sleep.assert_not_awaited()
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_call_glm_vision_api_honors_retry_after(self, mock_sleep, glm_api):
+        """Test GLM vision API call retries 429 after the Retry-After delay"""
+        glm_api.side_effect = [
+            httpx.Response(429, headers={"Retry-After": "30"}, json={}),
+            completion_stream("Recovered"),
+        ]
+
+        result = await call_glm_vision_api(
+            "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+        )
+
+        assert result == "Recovered"
+        mock_sleep.assert_awaited_once_with(30.0)
 
-    @pytest.mark.asyncio
-    async def test_call_glm_vision_api_no_api_key(self):
-        """Test GLM vision API call without API key"""
-        # Temporarily remove API key
-        original_key = os.environ.get("GLM_API_KEY")
-        if "GLM_API_KEY" in os.environ:
-            del os.environ["GLM_API_KEY"]
+    @patch("visual_mcp.server._client", None)
+    async def test_get_client_is_shared_and_replaced_once_closed(self):
+        """Test one client is reused until shutdown closes it"""
+        client = _get_client()
+        assert _get_client() is client
 
+        await client.aclose()
+        replacement = _get_client()
         try:
-            with pytest.raises(
-                ValueError, match="GLM_API_KEY environment variable not set"
-            ):
-                await call_glm_vision_api("test_data", "test prompt")
+            assert replacement is not client
+            assert not replacement.is_closed
         finally:
-            # Restore API key if it existed
-            if original_key:
-                os.environ["GLM_API_KEY"] = original_key
+            await replacement.aclose()
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_call_glm_vision_api_fails_on_long_retry_after(
+        self, mock_sleep, glm_api
+    ):
+        """Test a Retry-After beyond the cap fails instead of sleeping"""
+        glm_api.return_value = httpx.Response(
+            429, headers={"Retry-After": "86400"}, json={}
+        )
+
+        with pytest.raises(RuntimeError, match="GLM API error: 429"):
+            await call_glm_vision_api(
+                "data:image/jpeg;base64,dGVzdF9kYXRh", "test prompt"
+            )
+
+        assert glm_api.call_count == 1
+        mock_sleep.assert_not_awaited()
+
+    def test_is_retryable_status(self):
+        """Test transient statuses are retried and permanent ones are not"""
+        for status_code in (408, 425, 429, 500, 502, 503, 504):
+            assert is_retryable_status(status_code)
+        for status_code in (400, 401, 403, 404, 413, 422):
+            assert not is_retryable_status(status_code)
+
+    def test_parse_retry_after(self):
+        """Test Retry-After parsing for seconds, dates and junk values"""
+        assert parse_retry_after("5") == 5.0
+        assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+        assert parse_retry_after("soon") is None
+        assert parse_retry_after(None) is None
+
+    @patch("visual_mcp.server.asyncio.sleep", new_callable=AsyncMock)
+    async def test_rate_limiter_waits_when_bucket_is_empty(self, mock_sleep):
+        """Test the token bucket only delays once its burst is used up"""
+        limiter = RateLimiter(rate=2)
+
+        await limiter.acquire()
+        await limiter.acquire()
+        mock_sleep.assert_not_awaited()
+
+        # Simulate the sleep letting enough time pass to refill one token
+        async def advance(delay: float) -> None:
+            limiter._updated -= delay
+
+        mock_sleep.side_effect = advance
+        await limiter.acquire()
+        mock_sleep.assert_awaited()
+
+    def test_glm_config_no_api_key(self):
+        """Test configuration validation without API key"""
+        config = GlmConfig(api_key="", api_base="https://glm.test", model="glm-4.5v")
+        with pytest.raises(
+            ValueError, match="GLM_API_KEY environment variable not set"
+        ):
+            config.validate()
+
+    @patch("visual_mcp.server._CFG", GlmConfig("", "https://glm.test", "glm-4.5v"))
+    async def test_server_startup_fails_without_api_key(self):
+        """Test a missing API key is reported once, when the server starts"""
+        with pytest.raises(
+            ValueError, match="GLM_API_KEY environment variable not set"
+        ):
+            async with _lifespan(mcp):
+                pass
+
+    @patch("visual_mcp.server._CFG", TEST_CONFIG)
+    @patch("visual_mcp.server.GLM_MAX_CONCURRENCY", 0)
+    async def test_server_startup_fails_without_concurrency(self):
+        """Test a concurrency limit below 1 is rejected when the server starts"""
+        with pytest.raises(ValueError, match="GLM_MAX_CONCURRENCY must be at least 1"):
+            async with _lifespan(mcp):
+                pass
+
+    @patch("visual_mcp.server._glm_semaphore", None)
+    @patch("visual_mcp.server._glm_semaphore_loop", None)
+    def test_semaphore_is_created_per_event_loop(self):
+        """Test each event loop gets its own concurrency semaphore"""
+
+        async def get() -> asyncio.Semaphore:
+            first = _get_semaphore()
+            assert _get_semaphore() is first
+            return first
+
+        assert asyncio.run(get()) is not asyncio.run(get())
+
+    @patch("visual_mcp.server._CFG", TEST_CONFIG)
+    @patch("visual_mcp.server._client", None)
+    async def test_client_outlives_all_but_the_last_session(self):
+        """Test one session ending leaves the shared client to the others"""
+        async with _lifespan(mcp):
+            client = _get_client()
+            async with _lifespan(mcp):
+                pass
+            assert not client.is_closed
+
+        assert client.is_closed
+
+    def test_glm_config_hides_api_key(self):
+        """Test the API key is kept out of the config's repr"""
+        assert "test-api-key" not in repr(TEST_CONFIG)
+        assert TEST_CONFIG.headers["Authorization"] == "Bearer test-api-key"
 
 
 class TestUnifiedTool:
     """Test the unified analyze_image_with_context tool -
     the single tool for all image analysis needs"""
 
-    @pytest.mark.asyncio
     @patch("visual_mcp.server.call_glm_vision_api")
     @patch("visual_mcp.server.prepare_image_for_api")
-    async def test_analyze_image_with_context_success(self, mock_prepare, mock_glm_api):
+    async def test_analyze_image_with_context_success(
+        self, mock_prepare, mock_glm_api, mock_ctx
+    ):
         """Test successful image analysis with context"""
         # Mock dependencies
-        mock_prepare.return_value = ("prepared_base64_data", "image/jpeg")
+        mock_prepare.return_value = (
+            "data:image/jpeg;base64,prepared_base64_data",
+            False,
+        )
         mock_glm_api.return_value = "Comprehensive analysis based on user context"
 
-        # Mock context
-        mock_ctx = AsyncMock()
-
         result = await analyze_image_with_context(
             "test_image_data",
             "Extract and summarize all text in this document",
@@ -190,23 +752,22 @@ class TestUnifiedTool:
         assert "comprehensive visual analysis assistant" in call_args[1]
         mock_ctx.info.assert_called()
 
-    @pytest.mark.asyncio
     @patch("visual_mcp.server.call_glm_vision_api")
     @patch("visual_mcp.server.prepare_image_for_api")
     async def test_analyze_image_with_context_diagram_analysis(
-        self, mock_prepare, mock_glm_api
+        self, mock_prepare, mock_glm_api, mock_ctx
     ):
         """Test diagram analysis - unified tool handles specialized analysis
         through context"""
         # Mock dependencies
-        mock_prepare.return_value = ("prepared_base64_data", "image/jpeg")
+        mock_prepare.return_value = (
+            "data:image/jpeg;base64,prepared_base64_data",
+            False,
+        )
         mock_glm_api.return_value = (
             "Architecture diagram analysis with system flow explanation"
         )
 
-        # Mock context
-        mock_ctx = AsyncMock()
-
         result = await analyze_image_with_context(
             "test_diagram_data",
             "Analyze this architecture diagram and explain the system flow",
@@ -221,21 +782,20 @@ class TestUnifiedTool:
         assert "architecture diagram" in call_args[1].lower()
         assert "system flow" in call_args[1].lower()
 
-    @pytest.mark.asyncio
     @patch("visual_mcp.server.call_glm_vision_api")
     @patch("visual_mcp.server.prepare_image_for_api")
     async def test_analyze_image_with_context_text_extraction(
-        self, mock_prepare, mock_glm_api
+        self, mock_prepare, mock_glm_api, mock_ctx
     ):
         """Test text extraction - unified tool handles document analysis
         through context"""
         # Mock dependencies
-        mock_prepare.return_value = ("prepared_base64_data", "image/jpeg")
+        mock_prepare.return_value = (
+            "data:image/jpeg;base64,prepared_base64_data",
+            False,
+        )
         mock_glm_api.return_value = "Extracted text and summary from document"
 
-        # Mock context
-        mock_ctx = AsyncMock()
-
         result = await analyze_image_with_context(
             "test_document_data",
             "What does this contract say about termination clauses?",
@@ -250,20 +810,19 @@ class TestUnifiedTool:
         assert "termination clauses" in call_args[1]
         assert "text extraction" in call_args[1].lower()
 
-    @pytest.mark.asyncio
     @patch("visual_mcp.server.call_glm_vision_api")
     @patch("visual_mcp.server.prepare_image_for_api")
     async def test_analyze_image_with_context_custom_max_tokens(
-        self, mock_prepare, mock_glm_api
+        self, mock_prepare, mock_glm_api, mock_ctx
     ):
         """Test custom max tokens parameter"""
         # Mock dependencies
-        mock_prepare.return_value = ("prepared_base64_data", "image/jpeg")
+        mock_prepare.return_value = (
+            "data:image/jpeg;base64,prepared_base64_data",
+            False,
+        )
         mock_glm_api.return_value = "Analysis with custom token limit"
 
-        # Mock context
-        mock_ctx = AsyncMock()
-
         result = await analyze_image_with_context(
             "test_image_data", "Brief analysis needed", max_tokens=1000, ctx=mock_ctx
         )
@@ -272,50 +831,313 @@ class TestUnifiedTool:
 
         # Verify custom max_tokens is passed
         call_args = mock_glm_api.call_args
-        assert (
-            call_args[0][3] == 1000
-        )  # Fourth argument should be max_tokens (after mime_type)
+        assert call_args[0][2] == 1000  # Third argument should be max_tokens
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    @patch("visual_mcp.server.prepare_image_for_api")
+    async def test_analyze_image_with_context_prompt_prefix_is_stable(
+        self, mock_prepare, mock_glm_api
+    ):
+        """Test the fixed prompt preamble precedes the user's context"""
+        mock_prepare.return_value = (
+            "data:image/jpeg;base64,prepared_base64_data",
+            False,
+        )
+        mock_glm_api.return_value = "Analysis"
+
+        await analyze_image_with_context("test_image_data", "Explain {this} chart")
+
+        prompt = mock_glm_api.call_args[0][1]
+        assert prompt == PROMPT_PREFIX + "Explain {this} chart"
+
+
+class TestResponseCache:
+    """Test caching of analysis results"""
+
+    def test_response_cache_evicts_least_recently_used(self):
+        """Test the cache keeps only the most recently used entries"""
+        cache = ResponseCache(max_size=2)
+        cache.put("a", "result a")
+        cache.put("b", "result b")
+        assert cache.get("a") == "result a"  # "b" is now least recently used
+
+        cache.put("c", "result c")
+
+        assert cache.get("b") is None
+        assert cache.get("a") == "result a"
+        assert cache.get("c") == "result c"
+
+    def test_response_cache_skips_empty_results(self):
+        """Test an empty result is not cached"""
+        cache = ResponseCache()
+        cache.put("a", "")
+
+        assert cache.get("a") is None
+
+    def test_response_cache_key_depends_on_all_inputs(self):
+        """Test keys differ when image, context or token limit differ"""
+        key = ResponseCache.make_key("image", "context", 100)
+        assert key == ResponseCache.make_key("image", "context", 100)
+        assert key != ResponseCache.make_key("other", "context", 100)
+        assert key != ResponseCache.make_key("image", "other", 100)
+        assert key != ResponseCache.make_key("image", "context", 200)
+
+    @patch("visual_mcp.server.HASH_CHUNK_SIZE", 4)
+    def test_response_cache_key_hashes_image_in_chunks(self):
+        """Test chunked hashing covers the whole image"""
+        key = ResponseCache.make_key("data:image/png;base64,AAAA", "context", 100)
+        assert key != ResponseCache.make_key(
+            "data:image/png;base64,AAAB", "context", 100
+        )
+        image_digest = hashlib.sha256(b"data:image/png;base64,AAAA").hexdigest()
+        assert image_digest in key
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    @patch("visual_mcp.server.prepare_image_for_api")
+    async def test_analyze_image_with_context_uses_cache(
+        self, mock_prepare, mock_glm_api
+    ):
+        """Test repeated identical requests only call the API once"""
+        mock_prepare.return_value = (
+            "data:image/jpeg;base64,prepared_base64_data",
+            False,
+        )
+        mock_glm_api.return_value = "Cached analysis"
+
+        first = await analyze_image_with_context("test_image_data", "Describe this")
+        second = await analyze_image_with_context("test_image_data", "Describe this")
+
+        assert first == second == "Cached analysis"
+        mock_glm_api.assert_called_once()
+
+
+class TestSingleFlight:
+    """Test sharing of identical concurrent GLM requests"""
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_deduplicates_identical_requests(self, mock_glm_api):
+        """Test identical concurrent requests share one upstream call"""
+        mock_glm_api.return_value = "Shared analysis"
+        flights = SingleFlight()
+
+        try:
+            results = await asyncio.gather(
+                *(flights.process("image_url", "prompt", 100) for _ in range(3))
+            )
+        finally:
+            await flights.aclose()
+
+        assert results == ["Shared analysis"] * 3
+        mock_glm_api.assert_called_once()
+        assert mock_glm_api.call_args.args == ("image_url", "prompt", 100)
+        assert mock_glm_api.call_args.kwargs["validated"] is False
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_starts_fresh_call_once_finished(self, mock_glm_api):
+        """Test a request arriving after the shared call finished is sent again"""
+        mock_glm_api.return_value = "Analysis"
+        flights = SingleFlight()
+
+        assert await flights.process("image_url", "prompt", 100) == "Analysis"
+        assert await flights.process("image_url", "prompt", 100) == "Analysis"
+
+        assert mock_glm_api.call_count == 2
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_fans_out_results_and_errors(self, mock_glm_api):
+        """Test each distinct request receives its own result or error"""
+
+        async def fake_api(
+            image_url: str, prompt: str, max_tokens: int, validated: bool, on_delta
+        ) -> str:
+            if prompt == "fail":
+                raise RuntimeError("GLM API error: 500")
+            return f"analysis of {image_url}"
+
+        mock_glm_api.side_effect = fake_api
+        flights = SingleFlight()
+
+        try:
+            results = await asyncio.gather(
+                flights.process("first", "prompt", 100),
+                flights.process("second", "prompt", 100),
+                flights.process("third", "fail", 100),
+                return_exceptions=True,
+            )
+        finally:
+            await flights.aclose()
+
+        assert results[0] == "analysis of first"
+        assert results[1] == "analysis of second"
+        assert isinstance(results[2], RuntimeError)
+        assert mock_glm_api.call_count == 3
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_close_fails_waiting_callers(self, mock_glm_api):
+        """Test closing fails callers whose call is still in flight"""
+        never_done = asyncio.Event()
+
+        async def fake_api(*args, **kwargs) -> str:
+            await never_done.wait()
+            return "unreachable"
+
+        mock_glm_api.side_effect = fake_api
+        flights = SingleFlight()
+
+        pending = asyncio.gather(
+            flights.process("image_url", "prompt", 100),
+            flights.process("image_url", "prompt", 100),
+            return_exceptions=True,
+        )
+        await asyncio.sleep(0.01)
+        await flights.aclose()
+
+        results = await asyncio.wait_for(pending, timeout=1)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert "shutting down" in str(results[0])
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_relays_deltas_to_every_caller(self, mock_glm_api):
+        """Test streamed text reaches each caller sharing an upstream call"""
+
+        async def fake_api(*args, on_delta, **kwargs) -> str:
+            await on_delta("partial")
+            return "partial"
+
+        mock_glm_api.side_effect = fake_api
+        callbacks = [AsyncMock(), AsyncMock()]
+        flights = SingleFlight()
+
+        try:
+            await asyncio.gather(
+                *(
+                    flights.process("image_url", "prompt", 100, on_delta=callback)
+                    for callback in callbacks
+                )
+            )
+        finally:
+            await flights.aclose()
+
+        mock_glm_api.assert_called_once()
+        for callback in callbacks:
+            callback.assert_awaited_once_with("partial")
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_isolates_failing_listener(self, mock_glm_api):
+        """Test one caller's failing callback doesn't fail the shared call"""
+
+        async def fake_api(*args, on_delta, **kwargs) -> str:
+            await on_delta("first")
+            await on_delta("second")
+            return "first second"
+
+        mock_glm_api.side_effect = fake_api
+        failing = AsyncMock(side_effect=RuntimeError("session closed"))
+        healthy = AsyncMock()
+        flights = SingleFlight()
+
+        try:
+            results = await asyncio.gather(
+                flights.process("image_url", "prompt", 100, on_delta=failing),
+                flights.process("image_url", "prompt", 100, on_delta=healthy),
+            )
+        finally:
+            await flights.aclose()
+
+        assert results == ["first second"] * 2
+        mock_glm_api.assert_called_once()
+        failing.assert_awaited_once_with("first")
+        assert [c.args for c in healthy.await_args_list] == [("first",), ("second",)]
+
+    @patch("visual_mcp.server.call_glm_vision_api")
+    async def test_single_flight_stops_relaying_to_cancelled_caller(self, mock_glm_api):
+        """Test a cancelled caller no longer receives streamed text"""
+        resume = asyncio.Event()
+
+        async def fake_api(*args, on_delta, **kwargs) -> str:
+            await on_delta("first")
+            await resume.wait()
+            await on_delta("second")
+            return "first second"
+
+        mock_glm_api.side_effect = fake_api
+        cancelled = AsyncMock()
+        flights = SingleFlight()
+
+        try:
+            abandoned = asyncio.create_task(
+                flights.process("image_url", "prompt", 100, on_delta=cancelled)
+            )
+            remaining = asyncio.create_task(flights.process("image_url", "prompt", 100))
+            await asyncio.sleep(0.01)
+            abandoned.cancel()
+            await asyncio.sleep(0.01)
+            resume.set()
+            assert await asyncio.wait_for(remaining, timeout=1) == "first second"
+        finally:
+            await flights.aclose()
+
+        cancelled.assert_awaited_once_with("first")
+
+
+class TestEventLoop:
+    """Test optional uvloop support"""
+
+    def test_install_uvloop_without_uvloop(self):
+        """Test the default event loop is kept when uvloop is missing"""
+        with (
+            patch.dict("sys.modules", {"uvloop": None}),
+            patch("visual_mcp.server.asyncio.set_event_loop_policy") as mock_set,
+        ):
+            install_uvloop()
+
+        mock_set.assert_not_called()
+
+    def test_install_uvloop_with_uvloop(self):
+        """Test uvloop's policy is installed when available"""
+        fake_uvloop = MagicMock()
+        with (
+            patch.dict("sys.modules", {"uvloop": fake_uvloop}),
+            patch("visual_mcp.server.asyncio.set_event_loop_policy") as mock_set,
+        ):
+            install_uvloop()
+
+        mock_set.assert_called_once_with(fake_uvloop.EventLoopPolicy.return_value)
 
 
 class TestErrorHandling:
     """Test error handling in the unified tool"""
 
-    @pytest.mark.asyncio
     @patch("visual_mcp.server.call_glm_vision_api")
     @patch("visual_mcp.server.prepare_image_for_api")
     async def test_analyze_image_with_context_api_error(
-        self, mock_prepare, mock_glm_api
+        self, mock_prepare, mock_glm_api, mock_ctx
     ):
         """Test image analysis with API error"""
         # Mock dependencies to raise error
-        mock_prepare.return_value = ("prepared_data", "image/jpeg")
+        mock_prepare.return_value = ("data:image/jpeg;base64,prepared_data", False)
         mock_glm_api.side_effect = Exception("API Error")
 
-        # Mock context
-        mock_ctx = AsyncMock()
-
-        result = await analyze_image_with_context(
-            "test_data", "analyze this", ctx=mock_ctx
-        )
+        with pytest.raises(McpError, match="Image analysis failed: API Error") as exc:
+            await analyze_image_with_context("test_data", "analyze this", ctx=mock_ctx)
 
-        assert "Image analysis failed: API Error" in result
+        assert exc.value.error.code == INTERNAL_ERROR
         mock_ctx.error.assert_called_once()
 
-    @pytest.mark.asyncio
     @patch("visual_mcp.server.prepare_image_for_api")
-    async def test_analyze_image_with_context_preparation_error(self, mock_prepare):
+    async def test_analyze_image_with_context_preparation_error(
+        self, mock_prepare, mock_ctx
+    ):
         """Test image analysis with image preparation error"""
         # Mock preparation to raise error
         mock_prepare.side_effect = ValueError("Invalid image data")
 
-        # Mock context
-        mock_ctx = AsyncMock()
-
-        result = await analyze_image_with_context(
-            "test_data", "analyze this", ctx=mock_ctx
-        )
+        with pytest.raises(
+            McpError, match="Image analysis failed: Invalid image data"
+        ) as exc:
+            await analyze_image_with_context("test_data", "analyze this", ctx=mock_ctx)
 
-        assert "Image analysis failed: Invalid image data" in result
+        assert exc.value.error.code == INVALID_PARAMS
         mock_ctx.error.assert_called_once()
 
 